@@ -1,9 +1,26 @@
 import io
+import os
 import re
 import time
 import socket
 from random import randint
-import queue
+
+# CIA AUTH reply status line: a numeric UID followed by a caret.
+_CIA_AUTH_RE = re.compile(r'\d+\^')
+
+# The local host name and address only go into the handshake, so look them
+# up once per process rather than on every (re)connect of every connection.
+_LOCAL_HOSTNAME = socket.gethostname()
+_localAddress = None
+
+def _getLocalAddress():
+    global _localAddress
+    if _localAddress is None:
+        try:
+            _localAddress = socket.gethostbyname(_LOCAL_HOSTNAME)
+        except socket.error:
+            _localAddress = "127.0.0.1"
+    return _localAddress
 
 class RPCConnection(object):
     """
@@ -12,7 +29,7 @@ class RPCConnection(object):
     CIPHER = [ "******* place your Vista's cipher here*****"]
 
     def __init__(self, host, port, access, verify, context, logger,
-                 endMark, poolId):
+                 endMark, poolId, timeout=None):
         self.logger = logger
         self.host = host
         self.port = port
@@ -21,39 +38,81 @@ class RPCConnection(object):
         self.context = context
         self.endMark = endMark
         self.poolId = poolId
+        # Seconds to wait on connect/send/recv before giving up; None blocks
+        # forever. A timeout is raised to the caller, never retried.
+        self.timeout = timeout
         self.sock = None
+        # Reused for every recv_into() so large replies don't allocate a
+        # fresh bytes object per chunk.
+        self._rxbuf = bytearray(65536)
+        self._rxview = memoryview(self._rxbuf)
 
     def invokeRPC(self, name, params):
         if not self.sock:
             self.logger.logInfo("RPCConnection",
-                                "Connecting %d as Socket not initialized" % self.poolId)
-            self.connect()
-        e = None
+                                "Connecting %d as Socket not initialized", self.poolId)
+            self.__signOn()
         try:
             request = self.makeRequest(name, params)
-            self.sock.send(request.encode('utf-8'))
+            self.sock.sendall(request)
             msg = self.readToEndMarker()
+        except socket.timeout:
+            self.__abandonTimedOut()
+            raise
         except socket.error as e:
-            print(e)
+            self.logger.logError("RPCConnection", "Socket error on connection %d: %s", self.poolId, e)
             msg = ""
         if not len(msg):
             error_message = "empty reply"
             self.logger.logInfo("RPCConnection",
                                 "Forced to reconnect connection %d after reply \
-                                failed (%s))" % (self.poolId, error_message))
-            self.connect()
+                                failed (%s))", self.poolId, error_message)
+            self.__signOn()
             request = self.makeRequest(name, params)
-            self.sock.send(request.encode('utf-8'))
-            msg = self.readToEndMarker()
+            try:
+                self.sock.sendall(request)
+                msg = self.readToEndMarker()
+            except socket.timeout:
+                self.__abandonTimedOut()
+                raise
         return msg
 
+    def __signOn(self):
+        # A handshake that fails or times out part way leaves a socket that is
+        # not signed on, and may still have a late reply in flight that would
+        # be read as the next RPC's reply. Drop it so the next call starts over.
+        try:
+            self.connect()
+        except Exception:
+            sock, self.sock = self.sock, None
+            if sock:
+                sock.close()
+            raise
+
+    def __abandonTimedOut(self):
+        # The RPC may still be running on the server, so it must not be sent
+        # again: a write could apply twice, and a fresh session would have
+        # lost context such as the selected patient. Drop the socket (its
+        # late reply would desync the stream) and let the caller decide.
+        self.logger.logError("RPCConnection", "Timed out on connection %d", self.poolId)
+        sock, self.sock = self.sock, None
+        if sock:
+            sock.close()
+
+    def invokeRPCs(self, calls):
+        return [self.invokeRPC(name, params) for name, params in calls]
+
     def connect(self):
         if self.sock:
             self.sock.close()
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
         self.sock.connect((self.host, self.port))
+        # Requests are small and strictly request/response, so don't let
+        # Nagle's algorithm hold them back waiting for an ACK.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.logger.logInfo("RPCConnection", "Connecting to %s %d - Step1 for\
-        %d ..." % (self.host, self.port, self.poolId))
+        %d ...", self.host, self.port, self.poolId)
 
     def encrypt(cls, val):
         ra = randint(0, 18)
@@ -62,119 +121,142 @@ class RPCConnection(object):
             rb = randint(0, 18)
         cra = RPCConnection.CIPHER[ra]
         crb = RPCConnection.CIPHER[rb]
-        cval = chr(ra + 32)
-        for i in range(len(val)):
-            c = val[i]
-            index = cra.find(c)
-            if index == -1:
-                cval += str(c)
-            else:
-                cval += str(crb[index])
-        cval += chr(rb + 32)
+        # Substitute each character of row ra with the one at the same
+        # position in row rb; characters not in the cipher pass through.
+        table = str.maketrans(cra, crb)
+        cval = chr(ra + 32) + val.translate(table) + chr(rb + 32)
         return cval.encode("utf-8")
 
     def readToEndMarker(self):
-        msgChunks = []
+        # Work on the raw bytes and decode once at the end, so a multi-byte
+        # character split across two recv() calls still decodes correctly.
+        # Each new segment is scanned for the end marker with bytearray.find
+        # (a C memchr), so the marker is found wherever it lands in a chunk.
+        endMark = self.endMark.encode('latin-1')
+        view = self._rxview
+        acc = bytearray()
+        start = 0  # Skips the two-byte \x00 header at the front of a reply
+        searchFrom = 0
+        end = None
         noChunks = 0
-        msg = ""
         while 1:
-            msgChunk = self.sock.recv(256)
-            msgChunk = msgChunk.decode('utf-8')
-            if not msgChunk:
+            n = self.sock.recv_into(view)
+            if not n:
                 break
-            if not len(msgChunks):
-                if msgChunk[0] == "\x00":
-                    msgChunk = msgChunk[2:]
+            if not noChunks and view[0] == 0:
+                start = searchFrom = 2
             noChunks += 1
-            if msgChunk[-1] == self.endMark:
-                msgChunks.append(msgChunk[:-1])
+            acc += view[:n]
+            idx = acc.find(endMark, searchFrom)
+            if idx >= 0:
+                end = idx
                 break
-            msgChunks.append(msgChunk)
-        if len(msgChunks):
-            msg = "".join(msgChunks)
+            searchFrom = max(searchFrom, len(acc))
+        msg = acc[start:end].decode('utf-8')
         self.logger.logInfo("RPCConnection", "Message of length %d received in \
-        %d chunks on connection %d" % (len(msg), noChunks, self.poolId))
+        %d chunks on connection %d", len(msg), noChunks, self.poolId)
         return msg
 
     def close(self):
         if self.sock:
-            self.sock.send("#BYE#".encode('utf-8'))
+            self.sock.sendall("#BYE#".encode('utf-8'))
             self.sock.close()
 
 class VistARPCConnection(RPCConnection):
+    # The TCPConnect and XUS SIGNON SETUP requests are the same for every
+    # connection in the process, so they are built once on first connect.
+    _TCPCONNECT_REQUEST = None
+    _SIGNON_REQUEST = None
 
-    def __init__(self, host, port, access, verify, context, logger, poolId=-1):
+    def __init__(self, host, port, access, verify, context, logger, poolId=-1,
+                 timeout=None):
         RPCConnection.__init__(self, host, port, access, verify, context,
-                               logger, chr(4), poolId)
+                               logger, chr(4), poolId, timeout)
 
     def connect(self):
         RPCConnection.connect(self)
-        tcpConnect = self.makeRequest("TCPConnect",
-                                      [socket.gethostbyname(socket.gethostname
-                                                            ()), "0", "FMQL"], True)
-        self.sock.send(tcpConnect.encode('utf-8'))
+        cls = VistARPCConnection
+        if cls._TCPCONNECT_REQUEST is None:
+            # preconnect runs handshakes on several threads, so build both
+            # requests first and publish the one tested above last; another
+            # thread never sees a set _TCPCONNECT_REQUEST without its partner.
+            tcpConnect = self.makeRequest("TCPConnect",
+                                          [_getLocalAddress(), "0", "FMQL"], True)
+            cls._SIGNON_REQUEST = self.makeRequest("XUS SIGNON SETUP", [])
+            cls._TCPCONNECT_REQUEST = tcpConnect
+        self.sock.sendall(cls._TCPCONNECT_REQUEST)
         connectReply = self.readToEndMarker()
-        if not re.match(r'accept', connectReply):
+        if not connectReply.startswith('accept'):
             raise Exception("VistARPCConnection", connectReply)
-        signOn = self.makeRequest("XUS SIGNON SETUP", [])
-        self.sock.send(signOn.encode('utf-8'))
+        self.sock.sendall(cls._SIGNON_REQUEST)
         connectReply = self.readToEndMarker()
         accessVerify = self.encrypt(self.access + ";" + self.verify)
         accessVerify = accessVerify.decode()
         login = self.makeRequest("XUS AV CODE", [accessVerify])
-        self.sock.send(login.encode('utf-8'))
+        self.sock.sendall(login)
         connectReply = self.readToEndMarker()
-        if re.search(r'Not a valid ACCESS CODE/VERIFY CODE pair',
-                     connectReply):
+        if 'Not a valid ACCESS CODE/VERIFY CODE pair' in connectReply:
             raise Exception("VistARPCConnection", connectReply)
         eMSGCONTEXT = self.encrypt(self.context)
         eMSGCONTEXT = eMSGCONTEXT.decode()
         ctx = self.makeRequest("XWB CREATE CONTEXT", [eMSGCONTEXT])
-        self.sock.send(ctx.encode('utf-8'))
+        self.sock.sendall(ctx)
         connectReply = self.readToEndMarker()
-        self.logger.logInfo("CONNECT", "context reply is %s" % connectReply)
-        if re.search(r'Application context has not been created',
-                     connectReply) or\
-                     re.search(r'does not exist on server', connectReply):
+        self.logger.logInfo("CONNECT", "context reply is %s", connectReply)
+        if 'Application context has not been created' in connectReply or\
+                'does not exist on server' in connectReply:
             raise Exception("VistARPCConnection", connectReply)
         self.logger.logInfo("VistARPCConnection",
-                            "Handshake complete for connection %d" % self.poolId)
+                            "Handshake complete for connection %d", self.poolId)
 
     def makeRequest(self, name, params, isCommand=False):
-        protocoltoken = "[XWB]1130"
+        # Built directly as bytes in one buffer, ready for the socket.
+        request = bytearray(b"[XWB]1130")
         if isCommand:
-            commandtoken = "4"
+            request += b"4"
         else:
-            commandtoken = "2" + chr(1) + "1"
-        namespec = chr(len(name)) + name
-        paramsspecs = "5"
+            request += b"2\x011"
+        # Length prefixes count UTF-8 bytes, not characters, so each name,
+        # key and value is encoded once and measured after encoding.
+        name = name.encode('utf-8')
+        request.append(len(name))
+        request += name
+        request += b"5"
         if not len(params):
-            paramsspecs += "4" + "f"
+            request += b"4f"
+        elif not any(type(param) is dict for param in params):
+            # Common case of literals only: format them all in one join.
+            request += b"".join([b"0%03d%sf" % (len(param), param)
+                                 for param in [str(p).encode('utf-8') for p in params]])
         else:
             for param in params:
                 if type(param) is not dict:
-                    paramsspecs += "0"
-                    paramsspecs += str(len(param)).zfill(3) + str(param)
-                    paramsspecs += "f"
+                    param = str(param).encode('utf-8')
+                    request += b"0%03d" % len(param)
+                    request += param
+                    request += b"f"
                 else:
-                    paramsspecs += "2"
-                    paramIndex = 1
-                    for key, val in list(param.items()):
-                        if paramIndex > 1:
-                            paramsspecs += "t"
-                        paramsspecs += str(len(str(key))).zfill(3) + str(key)
-                        paramsspecs += str(len(str(val))).zfill(3) + str(val)
-                        paramIndex += 1
-                    paramsspecs += "f"
-        endtoken = chr(4)
-        return protocoltoken + commandtoken + namespec + paramsspecs + endtoken
+                    request += b"2"
+                    for paramIndex, (key, val) in enumerate(param.items()):
+                        if paramIndex:
+                            request += b"t"
+                        key = str(key).encode('utf-8')
+                        val = str(val).encode('utf-8')
+                        request += b"%03d" % len(key)
+                        request += key
+                        request += b"%03d" % len(val)
+                        request += val
+                    request += b"f"
+        request += b"\x04"
+        return bytes(request)
 
 
 class CIARPCConnection(RPCConnection):
 
-    def __init__(self, host, port, access, verify, context, logger, poolId=-1):
+    def __init__(self, host, port, access, verify, context, logger, poolId=-1,
+                 timeout=None):
         RPCConnection.__init__(self, host, port, access, verify, context,
-                               logger, chr(255), poolId)
+                               logger, chr(255), poolId, timeout)
         self.sequence = 0
         self.uid = ""
 
@@ -185,110 +267,180 @@ class CIARPCConnection(RPCConnection):
         self.logger.logInfo("CIACONNECT", "Sending CIA Connect")
         ciaConnect = self.__makeCIARequest("C", {"IP": myAddress, "UCI": uci,
                                                  "DBG": "0", "LP": "0", "VER": "1.6.5.26"})
-        self.sock.send(ciaConnect.encode('utf-8'))
+        self.sock.sendall(ciaConnect)
         connectReply = self.readToEndMarker()
-        self.logger.logInfo("CIACONNECT", "STEP 1 SUCCESS: " + connectReply)
+        self.logger.logInfo("CIACONNECT", "STEP 1 SUCCESS: %s", connectReply)
         accessVerify = self.encrypt(self.access + ";" + self.verify)
-        computerName = socket.gethostname()
+        computerName = _LOCAL_HOSTNAME
         self.uid = ""
         ciaConnect = self.makeRequest("CIANBRPC AUTH", ["CIAV VUECENTRIC",
                                                         computerName, "", accessVerify])
-        self.sock.send(ciaConnect.encode('utf-8'))
+        self.sock.sendall(ciaConnect)
         connectReply = self.readToEndMarker()
         replyLines = connectReply.split("\r")
-        if not (len(replyLines) > 1 and re.match(r'\d+\\^', replyLines[1])):
+        if not (len(replyLines) > 1 and _CIA_AUTH_RE.match(replyLines[1])):
             eMsg = "STEP 2 FAIL"
             self.logger.logError("CIACONNECT", eMsg)
             raise Exception("CIACONNECT", eMsg)
-        self.uid = re.match(r'([^\\^]+)', replyLines[1]).group(1)
-        self.logger.logInfo("CIACONNECT", "STEP 2 SUCCESS - Connected. UID %s" % self.uid)
+        self.uid = replyLines[1].partition('^')[0]
+        self.logger.logInfo("CIACONNECT", "STEP 2 SUCCESS - Connected. UID %s", self.uid)
 
     def makeRequest(self, rpcName, params):
         rpcParams = {"CTX": self.context, "UID": self.uid, "VER": "0", "RPC": rpcName}
-        for i in range(len(params)):
-            rpcParams[str(i+1)] = params[i]
+        for i, param in enumerate(params, 1):
+            rpcParams[str(i)] = param
         return self.__makeCIARequest("R", rpcParams)
 
     def __makeCIARequest(self, rtype, params):
-        headerToken = "{CIA}"
-        EODToken = chr(255)
+        # {CIA}, EOD, sequence byte, request type, then id\0value pairs and a
+        # closing EOD, all built as bytes in one buffer.
         self.sequence += 1
         if self.sequence == 256:
             self.sequence = 1
-        sequence = chr(self.sequence)
+        request = bytearray(b"{CIA}\xff")
+        request.append(self.sequence)
         if rtype == "R":
-            brtype = chr(82)
+            request += b"R"
         else:
-            brtype = chr(67)
-        paramsspecs = ""
+            request += b"C"
         for paramId, paramValue in params.items():
-            paramsspecs += self.__byteIt(paramId) + chr(0) + self.__byteIt(paramValue)
-        return headerToken + EODToken + sequence + brtype + paramsspecs + EODToken
+            request += self.__byteIt(paramId)
+            request.append(0)
+            request += self.__byteIt(paramValue)
+        request.append(255)
+        return bytes(request)
 
     def __byteIt(self, strVal):
-        slen = len(strVal)
-        low = slen % 16
-        slen = slen >> 4
-        bytes = bytearray()
-        highCount = 0
-        while slen != 0:
-            bytes.append(slen & 0xFF)
-            slen = slen >> 8
-            highCount += 1
-        fbytes = bytearray()
-        fbytes.append((highCount << 4) + low)
-        for idx in reversed(range(0, len(bytes))):
-            fbytes.append(bytes[idx])
-        fbytes.extend(bytearray(strVal))
-        return fbytes
-
-import queue
+        # Length-prefixed value: the header byte holds the low 4 bits of the
+        # length and, in its high nibble, how many big-endian bytes of the
+        # remaining length follow. Most ids and values are under 16 bytes.
+        if isinstance(strVal, bytes):
+            data = strVal
+        else:
+            data = str(strVal).encode('utf-8')
+        slen = len(data)
+        if slen < 16:
+            return bytes((slen,)) + data
+        high = slen >> 4
+        highBytes = high.to_bytes((high.bit_length() + 7) // 8, 'big')
+        return bytes(((len(highBytes) << 4) + (slen & 0x0F),)) + highBytes + data
+
+import collections
+import threading
+import concurrent.futures
 
 class RPCConnectionPool:
 
     def __init__(self, brokerType, poolSize, host, port, access,
-                 verify, context, logger):
+                 verify, context, logger, timeout=None):
         self.logger = logger
-        self.__connectionQueue = queue.LifoQueue()
+        # Idle connections as a LIFO stack, with a semaphore counting how many
+        # are available. The lock only guards against close() emptying the
+        # stack between a borrower's acquire and its pop.
+        self.__connections = collections.deque()
+        self.__available = threading.Semaphore(0)
+        self.__lock = threading.Lock()
+        self.__closed = False
         self.__prebuildConnections(brokerType, poolSize, host, port,
-                                   access, verify, context)
+                                   access, verify, context, timeout)
 
     def __prebuildConnections(self, brokerType, poolSize, host, port,
-                              access, verify, context):
+                              access, verify, context, timeout):
         for i in range(poolSize, 0, -1):
             if brokerType == "CIA":
                 connection = CIARPCConnection(host, port, access,
-                                              verify, context, self.logger, i)
+                                              verify, context, self.logger, i,
+                                              timeout)
             else:
                 connection = VistARPCConnection(host, port, access,
-                                                verify, context, self.logger, i)
-            self.__connectionQueue.put(connection)
-        self.logger.logInfo("CONN POOL", "Initialized %d connections" % poolSize)
+                                                verify, context, self.logger, i,
+                                                timeout)
+            self.__put(connection)
+        self.logger.logInfo("CONN POOL", "Initialized %d connections", poolSize)
         self.poolSize = poolSize
 
+    def __get(self):
+        self.__available.acquire()
+        with self.__lock:
+            if self.__closed:
+                # Pass the wake-up on so every other waiter fails too.
+                self.__available.release()
+                raise ConnectionError("Connection pool is closed")
+            return self.__connections.pop()
+
+    def __put(self, connection):
+        with self.__lock:
+            if not self.__closed:
+                self.__connections.append(connection)
+                self.__available.release()
+                return
+        # Borrowed when the pool was closed; close it now it is back.
+        self.__closeConnection(connection)
+
     def invokeRPC(self, name, params):
-        connection = self.__connectionQueue.get()
+        return self.invokeRPCs([(name, params)])[0]
+
+    def invokeRPCs(self, calls):
+        # Run a list of (name, params) calls back to back on one borrowed
+        # connection: one pool round trip for the lot, and the calls share
+        # a broker session, so later ones see state set by earlier ones.
+        connection = self.__get()
         try:
-            reply = connection.invokeRPC(name, params)
-        except Exception as e:
+            return connection.invokeRPCs(calls)
+        except Exception:
             self.logger.logError("CONN POOL", "Basic connectivity problem.\
             Connection was refused so RPC invocation failed.")
-            raise e
-        self.__connectionQueue.put(connection)
-        return reply
+            self.__reset(connection)
+            raise
+        finally:
+            # Always hand the connection back, otherwise every failure
+            # permanently shrinks the pool until invokeRPC blocks forever.
+            self.__put(connection)
+
+    def __reset(self, connection):
+        # Drop a broken socket; the next borrower reconnects lazily.
+        sock, connection.sock = connection.sock, None
+        if sock:
+            sock.close()
 
     def preconnect(self, number):
         if number > self.poolSize:
             number = self.poolSize
-        connections = []
-        for i in range(number):
-            connection = self.__connectionQueue.get()
-            connection.connect()
-            connections.append(connection)
-        for i in range(number):
-            self.__connectionQueue.put(connections[i])
+        connections = [self.__get() for i in range(number)]
+        if not connections:
+            return
+        # Each handshake is several blocking round trips, so run them side by
+        # side; warming the pool then takes about as long as one connect.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=number) as executor:
+            futures = [executor.submit(connection.connect) for connection in connections]
+        error = None
+        for connection, future in zip(connections, futures):
+            if future.exception() is not None:
+                error = error or future.exception()
+                self.__reset(connection)
+            self.__put(connection)
+        if error is not None:
+            raise error
+
+    def close(self):
+        # Close the idle connections now and the borrowed ones as they are
+        # returned, rather than waiting for them. Waiting borrowers and any
+        # later calls raise ConnectionError.
+        with self.__lock:
+            self.__closed = True
+            idle = list(self.__connections)
+            self.__connections.clear()
+            self.__available.release()
+        for connection in idle:
+            self.__closeConnection(connection)
+
+    def __closeConnection(self, connection):
+        try:
+            connection.close()
+        except socket.error as e:
+            self.logger.logError("CONN POOL", "Error closing connection %d: %s",
+                                 connection.poolId, e)
 
-import threading
 
 class ThreadedRPCInvoker(threading.Thread):
     def __init__(self, pool, requestName, requestParameters):
@@ -304,15 +456,20 @@ class ThreadedRPCInvoker(threading.Thread):
 
 class RPCLogger:
     def __init__(self):
-        pass
+        # VISTA_RPC_QUIET=1 drops info messages before they are formatted.
+        self.quiet = bool(os.environ.get("VISTA_RPC_QUIET"))
 
-    def logInfo(self, tag, msg):
-        self.__log(tag, msg)
+    def logInfo(self, tag, msg, *args):
+        if not self.quiet:
+            self.__log(tag, msg, args)
 
-    def logError(self, tag, msg):
-        self.__log(tag, msg)
+    def logError(self, tag, msg, *args):
+        self.__log(tag, msg, args)
 
-    def __log(self, tag, msg):
+    def __log(self, tag, msg, args):
+        # Callers pass %-style args so formatting only happens when emitted.
+        if args:
+            msg = msg % args
         print(("BROKERRPC -- %s %s" % (tag, msg)))
 
 import getopt, sys
@@ -1,7 +1,37 @@
 import os
 import re
+import pickle
+import hashlib
+
+# Line patterns for the RPC documentation markdown:
+#   ### Category
+#   *   **`RPC NAME`**: description
+#       *   **Parameters**: ...
+#       *   **Returns**: ... (may continue on following lines)
+_RPC_BULLET_RE = re.compile(r"\*\s+\*\*`")
+_RPC_LINE_RE = re.compile(r"\*\s+\*\*`([^`]+)`\*\*:(.*)")
+_FIELD_LINE_RE = re.compile(r"\s+\*\s+\*\*(Parameters|Returns)\*\*:(.*)")
+
+# Parsed RPC lists/docs are cached here between runs, see RPCConfigLoader.load_all.
+# Bump CACHE_VERSION whenever the pickled layout or the parsed output changes.
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "vista_rpc")
+CACHE_VERSION = 3
+
+class RpcEntry:
+    # Documentation for one RPC. Slots instead of a per-RPC dict since every
+    # entry has the same three fields and there are hundreds of them.
+    __slots__ = ("description", "parameters", "returns")
+
+    def __init__(self, description, parameters, returns):
+        self.description = description
+        self.parameters = parameters
+        self.returns = returns
 
 class RPCConfigLoader:
+    __slots__ = ("rpc_list_file", "rpc_doc_file", "important_rpcs_filter",
+                 "all_rpc_names", "all_rpc_info", "rpc_names", "rpc_info",
+                 "_loaded_stamp")
+
     def __init__(self, rpc_list_file, rpc_doc_file, important_rpcs_filter=None):
         self.rpc_list_file = rpc_list_file
         self.rpc_doc_file = rpc_doc_file
@@ -10,6 +40,53 @@ class RPCConfigLoader:
         self.all_rpc_info = {}
         self.rpc_names = []
         self.rpc_info = {}
+        self._loaded_stamp = None
+
+    def _source_stamp(self):
+        # (mtime, size) of both source files; any edit invalidates cached results.
+        try:
+            list_stat = os.stat(self.rpc_list_file)
+            doc_stat = os.stat(self.rpc_doc_file)
+        except OSError:
+            return None
+        return (list_stat.st_mtime, list_stat.st_size, doc_stat.st_mtime, doc_stat.st_size)
+
+    def _cache_path(self):
+        key = os.path.abspath(self.rpc_list_file) + "\0" + os.path.abspath(self.rpc_doc_file)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(CACHE_DIR, f"config_v{CACHE_VERSION}_{digest}.pkl")
+
+    def _load_cache(self, stamp):
+        # A corrupt or stale pickle can raise almost anything (AttributeError,
+        # ImportError, MemoryError, ...); treat it as a miss and reparse.
+        try:
+            with open(self._cache_path(), 'rb') as f:
+                cached_stamp, names, info = pickle.load(f)
+        except Exception:
+            return False
+        if cached_stamp != stamp:
+            return False
+        self.all_rpc_names = names
+        self.all_rpc_info = info
+        return True
+
+    def _save_cache(self, stamp):
+        # The cache is only an optimization, so failing to write it is not an error.
+        # Write to a temporary file and rename it into place, so a crash or a
+        # concurrent reader never sees a half-written pickle.
+        path = self._cache_path()
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((stamp, self.all_rpc_names, self.all_rpc_info), f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
 
     def load_rpc_list(self):
         try:
@@ -20,37 +97,54 @@ class RPCConfigLoader:
 
     def load_from_markdown(self):
         try:
-            with open(self.rpc_doc_file, 'r') as f:
-                content = f.read()
+            f = open(self.rpc_doc_file, 'r')
         except FileNotFoundError:
             raise FileNotFoundError(f"RPC documentation file not found: {self.rpc_doc_file}")
 
-        # Regex to find categories and their RPCs
-        category_pattern = re.compile(r"### (.*?)\n(.*?)(?=\n### |\Z)", re.S)
-        rpc_pattern = re.compile(
-            r"^\*\s+\*\*`([^`]+)`\*\*:\s*(.*?)\n"  # RPC name and description
-            r"^\s+\*\s+\*\*Parameters\*\*:\s*(.*?)\n" # Parameters
-            r"^\s+\*\s+\*\*Returns\*\*:\s*(.*?)" # Returns
-            r"(?=\n^\*\s+\*\*`|\n### |\Z)", # Lookahead for next RPC or category or end of file
-            re.M | re.S
-        )
-
-        for cat_match in category_pattern.finditer(content):
-            category = cat_match.group(1).strip()
-            rpc_content = cat_match.group(2)
-            self.all_rpc_info[category] = {}
-
-            for rpc_match in rpc_pattern.finditer(rpc_content):
-                rpc_name = rpc_match.group(1).strip()
-                description = rpc_match.group(2).strip()
-                parameters = rpc_match.group(3).strip()
-                returns = rpc_match.group(4).strip()
-
-                self.all_rpc_info[category][rpc_name] = {
-                    "description": description,
-                    "parameters": parameters,
-                    "returns": returns
-                }
+        # Parse line by line rather than reading the whole file and running
+        # multiline regexes over it. Each field may wrap onto following lines,
+        # which are added to whichever field is open; an entry only ends at
+        # the next RPC bullet or category heading, and is recorded if its
+        # Parameters and Returns lines were both seen, in that order.
+        self.all_rpc_info = {}
+        category = None
+        rpc = None  # [name, description, parameters, returns] line lists
+        field = None  # Index into rpc of the field being accumulated
+
+        def finish():
+            if rpc is not None and field == 3:
+                self.all_rpc_info[category][rpc[0]] = RpcEntry(
+                    *["\n".join(lines).strip() for lines in rpc[1:]])
+
+        with f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("### "):
+                    finish()
+                    rpc = None
+                    category = line[4:].strip()
+                    self.all_rpc_info[category] = {}
+                    continue
+                if category is None:
+                    continue
+
+                if _RPC_BULLET_RE.match(line):
+                    finish()
+                    rpc_match = _RPC_LINE_RE.match(line)
+                    if rpc_match:
+                        rpc = [rpc_match.group(1).strip(), [rpc_match.group(2)], [], []]
+                        field = 1
+                    else:
+                        rpc = None
+                elif rpc is not None:
+                    field_match = _FIELD_LINE_RE.match(line)
+                    if field_match and field < 3 and \
+                            field_match.group(1) == ("Parameters", "Returns")[field - 1]:
+                        field += 1
+                        rpc[field].append(field_match.group(2))
+                    else:
+                        rpc[field].append(line)
+            finish()
 
     def filter_rpcs(self):
         if self.important_rpcs_filter:
@@ -62,8 +156,19 @@ class RPCConfigLoader:
         self.rpc_info = self.all_rpc_info
 
     def load_all(self):
-        self.load_rpc_list()
-        self.load_from_markdown()
+        # The list and documentation files are static for the life of the
+        # process, so only re-read them if either one has been modified.
+        stamp = self._source_stamp()
+        if stamp is not None and stamp == self._loaded_stamp:
+            return self.rpc_names, self.rpc_info
+        # Across runs, reuse the parsed results pickled under CACHE_DIR as long
+        # as neither source file has changed since they were written.
+        if stamp is None or not self._load_cache(stamp):
+            self.load_rpc_list()
+            self.load_from_markdown()
+            if stamp is not None:
+                self._save_cache(stamp)
         self.rpc_info = {k: v for k, v in self.rpc_info.items() if v} # Filter out empty categories
         self.filter_rpcs()
+        self._loaded_stamp = stamp
         return self.rpc_names, self.rpc_info
@@ -1,26 +1,77 @@
 import sys
 import os
 import re
+import time
 from vavista.rpc import connect, PLiteral, PList, PReference, PEncoded, PWordProcess
 
+# IEN and name (the first two caret fields) of each line in an IEN^Name^...
+# reply such as ORWU HOSPLOC or ORWU NEWPERS.
+_IEN_NAME_RE = re.compile(r"^([^^\r\n]*)\^([^^\r\n]*)", re.MULTILINE)
+
 class VistAClient:
+    # Single-value parameter prefixes and the vavista.rpc type each maps to.
+    # "wordproc:" takes the rest of the part as the text, so multi-line word
+    # processing input should use real newlines in the GUI.
+    _SCALAR_PREFIXES = (
+        ("literal:", PLiteral),
+        ("ref:", PReference),
+        ("encoded:", PEncoded),
+        ("wordproc:", PWordProcess),
+    )
+
+    # Constant TIU DOCUMENTS BY CONTEXT arguments around the patient DFN, built
+    # once since PLiteral values are only read when a request is sent. The ten
+    # trailing empties are FMBeginDate, FMEndDate, Author, MaxDocs, SortBy,
+    # ListAscending, GroupBy, SearchField, Keyword and SearchString.
+    _NOTES_CONTEXT = PLiteral("3")
+    _NOTES_TRAILING = (PLiteral(""),) * 10
+
+    # Seconds that cached reference data (locations, providers) stays valid.
+    CACHE_TTL = 15 * 60
+
     def __init__(self):
         self.connection = None
-
-    def connect_to_vista(self, host, port, access, verify, context):
-        if not all([host, port, access, verify, context]):
+        # (fetched_at, result) for slowly-changing reference RPCs, keyed by
+        # (rpc name, *args). Entries are reused until CACHE_TTL expires.
+        self._rpc_cache = {}
+        # ORWU USERINFO reply for the signed-on user; it cannot change until
+        # the next connect, so it is fetched at most once per session.
+        self._user_info = None
+
+    def connect_to_vista(self, host, port, access, verify, context, timeout=None, debug=False):
+        if not (host and port and access and verify and context):
             raise ValueError("All connection fields must be filled.")
         
-        self.connection = connect(host, int(port), access, verify, context)
+        self.connection = connect(host, int(port), access, verify, context, debug=debug,
+                                  timeout=timeout)
+        self.clear_cache()
         return "Connection successful!"
 
     def disconnect(self):
         if self.connection:
             self.connection.close()
             self.connection = None
+            self.clear_cache()
             return "Disconnected from VistA."
         return "Not connected."
 
+    def clear_cache(self):
+        self._rpc_cache = {}
+        self._user_info = None
+
+    def _cached(self, key, fetch, *args):
+        entry = self._rpc_cache.get(key)
+        if entry is not None and time.monotonic() - entry[0] < self.CACHE_TTL:
+            return entry[1]
+        result = fetch(*args)
+        self._rpc_cache[key] = (time.monotonic(), result)
+        return result
+
+    def _require_connection(self):
+        if not self.connection:
+            raise ConnectionError("Not connected to VistA.")
+        return self.connection
+
     def _parse_params(self, params_str):
         params = []
         if not params_str:
@@ -29,7 +80,10 @@ class VistAClient:
         # Split parameters by semicolon or newline, but not within quoted strings.
         # This regex handles cases like: literal:"value with;semicolon",literal:another
         # It splits by ; or \n only if they are not inside double quotes.
-        parts = re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)|\n', params_str)
+        if ';' in params_str or '\n' in params_str:
+            parts = re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)|\n', params_str)
+        else:
+            parts = [params_str]  # Single parameter, nothing to split
 
         for part in parts:
             part = part.strip()
@@ -37,19 +91,19 @@ class VistAClient:
                 continue
 
             # Determine parameter type based on prefix
-            if part.lower().startswith("literal:"):
-                params.append(PLiteral(part[len("literal:"):]))
-            elif part.lower().startswith("list:"):
+            # Only the prefix needs case folding; "wordproc:" is the longest.
+            lowered = part[:9].lower()
+            if lowered.startswith("list:"):
                 # Format: list:key1=value1;key2=value2 or list:item1;item2
                 list_content = part[len("list:"):]
-                p_list = PList()
+                list_values = {}
                 # Split list items by semicolon, respecting quotes
                 list_items = re.split(r';(?=(?:[^"]*"[^"]*")*[^"]*$)', list_content)
                 for item in list_items:
                     item = item.strip()
                     if '=' in item:
                         key, value = item.split('=', 1)
-                        p_list[key.strip()] = value.strip()
+                        list_values[key.strip()] = value.strip()
                     else:
                         # For non-keyed list items, vavista.rpc.PList.append() is not available.
                         # We'll treat them as keyed with an empty string or sequential numbers if needed by RPC.
@@ -59,20 +113,14 @@ class VistAClient:
                         # A better approach for non-keyed lists might be to pass them as a single literal with newlines.
                         # However, the Delphi code uses Mult[IntToStr(i+1)] := Strings[i], implying keyed list.
                         # So, we'll assume key-value pairs or single values that become keys with empty values.
-                        p_list[item] = "" # Assign empty string as value if no '='
-                params.append(p_list)
-            elif part.lower().startswith("ref:"):
-                params.append(PReference(part[len("ref:"):]))
-            elif part.lower().startswith("encoded:"):
-                params.append(PEncoded(part[len("encoded:"):]))
-            elif part.lower().startswith("wordproc:"):
-                # Word processing parameters are typically multi-line text.
-                # The content after "wordproc:" is treated as the entire text.
-                # vavista.rpc.PWordProcess is the correct type for this.
-                # Assuming the content for wordproc is everything after the prefix until the next parameter.
-                # For simplicity, we'll take the rest of the 'part' as the word processing text.
-                # If multi-line, the input in the GUI should use actual newlines.
-                params.append(PWordProcess(part[len("wordproc:"):]))
+                        list_values[item] = "" # Assign empty string as value if no '='
+                params.append(PList(list_values))
+                continue
+
+            for prefix, param_type in self._SCALAR_PREFIXES:
+                if lowered.startswith(prefix):
+                    params.append(param_type(part[len(prefix):]))
+                    break
             else:
                 # Default to literal if no prefix is given
                 params.append(PLiteral(part))
@@ -92,31 +140,46 @@ class VistAClient:
         reply = self.connection.invoke(rpc_name, *params)
         return reply
 
+    def keep_alive(self):
+        # XWB IM HERE resets the broker's idle timer, so the session (and any
+        # server-side state such as the selected patient) is not dropped and
+        # the next call doesn't have to reconnect and sign on again.
+        return self._require_connection().invoke("XWB IM HERE")
+
     def get_user_info(self):
-        if not self.connection:
-            raise ConnectionError("Not connected to VistA.")
-        return self.connection.invoke("ORWU USERINFO")
+        connection = self._require_connection()
+        if not self._user_info:
+            self._user_info = connection.invoke("ORWU USERINFO")
+        return self._user_info
+
+    def get_hospital_locations(self, start_from="", direction="1"):
+        return self._cached(("ORWU HOSPLOC", start_from, direction),
+                            self._fetch_name_map, "ORWU HOSPLOC", start_from, direction)
+
+    def get_providers(self, start_from="", direction="1"):
+        return self._cached(("ORWU NEWPERS", start_from, direction),
+                            self._fetch_name_map, "ORWU NEWPERS", start_from, direction)
+
+    def _fetch_name_map(self, rpc_name, start_from, direction):
+        reply = self._require_connection().invoke(rpc_name, PLiteral(start_from), PLiteral(direction))
+        # Parse into a name -> IEN map once per fetch, so cache hits skip
+        # parsing too. One findall scans the whole reply in C instead of
+        # splitting it into lines and partitioning each one.
+        return {name: ien for ien, name in _IEN_NAME_RE.findall(reply)}
 
     def get_doctor_patients(self, provider_ien):
-        if not self.connection:
-            raise ConnectionError("Not connected to VistA.")
-        return self.connection.invoke("ORQPT PROVIDER PATIENTS", PLiteral(provider_ien))
+        return self._require_connection().invoke("ORQPT PROVIDER PATIENTS", PLiteral(provider_ien))
 
     def select_patient(self, dfn):
-        if not self.connection:
-            raise ConnectionError("Not connected to VistA.")
-        return self.connection.invoke("ORWPT SELECT", PLiteral(dfn))
+        return self._require_connection().invoke("ORWPT SELECT", PLiteral(dfn))
 
     def search_patient(self, search_term):
-        if not self.connection:
-            raise ConnectionError("Not connected to VistA.")
+        connection = self._require_connection()
         if not search_term:
             raise ValueError("Please enter a patient name to search.")
-        return self.connection.invoke("ORWPT LIST ALL", PLiteral(search_term), PLiteral("1"))
+        return connection.invoke("ORWPT LIST ALL", PLiteral(search_term), PLiteral("1"))
 
     def fetch_patient_notes(self, dfn):
-        if not self.connection:
-            raise ConnectionError("Not connected to VistA.")
         # Context Status (NC_CUSTOM) - literal:3
         # Patient.DFN - literal:dfn
         # FMBeginDate (empty for all dates) - literal:
@@ -130,16 +193,7 @@ class VistAClient:
         # Keyword (empty) - literal:
         # Filtered (empty) - literal:
         # SearchString (empty) - literal:
-        return self.connection.invoke("TIU DOCUMENTS BY CONTEXT", 
-                                        PLiteral("3"),  # Context Status (NC_CUSTOM)
-                                        PLiteral(dfn),  # Patient.DFN
-                                        PLiteral(""),   # FMBeginDate (empty for all dates)
-                                        PLiteral(""),   # FMEndDate (empty for all dates)
-                                        PLiteral(""),   # Author (empty)
-                                        PLiteral(""),   # MaxDocs (empty for no limit)
-                                        PLiteral(""),   # SortBy (empty)
-                                        PLiteral(""),   # ListAscending (empty)
-                                        PLiteral(""),   # GroupBy (empty)
-                                        PLiteral(""),   # SearchField (empty)
-                                        PLiteral(""),   # Keyword (empty)
-                                        PLiteral(""))   # SearchString (empty)
+        return self._require_connection().invoke("TIU DOCUMENTS BY CONTEXT",
+                                                 self._NOTES_CONTEXT,  # Context Status (NC_CUSTOM)
+                                                 PLiteral(dfn),        # Patient.DFN
+                                                 *self._NOTES_TRAILING)
@@ -3,19 +3,25 @@ import os
 import threading
 import queue
 
-from broker_rpc import VistARPCConnection, CIARPCConnection
+from broker_rpc import VistARPCConnection, CIARPCConnection, RPCConnectionPool
 
 class RPCLogger:
-    def __init__(self):
-        pass
+    def __init__(self, verbose=True):
+        # Info messages are dropped before they are formatted unless verbose;
+        # VISTA_RPC_QUIET=1 drops them regardless. Errors are always printed.
+        self.quiet = not verbose or bool(os.environ.get("VISTA_RPC_QUIET"))
 
-    def logInfo(self, tag, msg):
-        self.__log(tag, msg)
+    def logInfo(self, tag, msg, *args):
+        if not self.quiet:
+            self.__log(tag, msg, args)
 
-    def logError(self, tag, msg):
-        self.__log(tag, msg)
+    def logError(self, tag, msg, *args):
+        self.__log(tag, msg, args)
 
-    def __log(self, tag, msg):
+    def __log(self, tag, msg, args):
+        # Callers pass %-style args so formatting only happens when emitted.
+        if args:
+            msg = msg % args
         print(f"BROKERRPC -- {tag} {msg}")
 
 class PLiteral:
@@ -44,21 +50,21 @@ class PWordProcess:
     def __init__(self, value):
         self.value = str(value)
 
+_PARAM_TYPES = (PLiteral, PList, PReference, PEncoded, PWordProcess)
+
 class Connection:
     def __init__(self, conn):
         self._conn = conn
 
     def invoke(self, rpcid, *params):
-        processed_params = []
-        for param in params:
-            if isinstance(param, PLiteral) or isinstance(param, PReference) or isinstance(param, PEncoded) or isinstance(param, PWordProcess):
-                processed_params.append(param.value)
-            elif isinstance(param, PList):
-                processed_params.append(param.value)
-            else: # Default to PLiteral if no specific type is given
-                processed_params.append(str(param))
+        # Typed params carry their broker value; anything else defaults to a literal.
+        processed_params = [param.value if isinstance(param, _PARAM_TYPES) else str(param)
+                            for param in params]
         return self._conn.invokeRPC(rpcid, processed_params)
 
+    def close(self):
+        self._conn.close()
+
     def l_invoke(self, rpcid, *params):
         # This is a simplified l_invoke. In a real scenario, you'd need to parse
         # the string response from VistA into a Python list based on delimiters.
@@ -66,10 +72,28 @@ class Connection:
         response = self.invoke(rpcid, *params)
         return response.split('\r\n')
 
-def connect(hostname, port, access_code, verify_code, context, debug=False):
-    logger = RPCLogger()
+def connect(hostname, port, access_code, verify_code, context, debug=False, pool_size=None,
+            timeout=None):
+    # Per-RPC broker info (connects, reply sizes) is only printed with debug.
+    logger = RPCLogger(verbose=debug)
     # The brokerRPC3.py script expects the context to be passed directly.
     # The hardcoded context in brokerRPC3.py's main_test() is "OR CPRS GUI CHART"
     # We will use the provided context here.
-    conn = VistARPCConnection(hostname, int(port), access_code, verify_code, context, logger)
+    if pool_size and pool_size > 1:
+        # Each pooled socket is its own broker session, so server-side state
+        # such as the selected patient is not shared between calls. Only use
+        # a pool for independent, stateless RPCs.
+        conn = RPCConnectionPool("VistA", pool_size, hostname, int(port), access_code,
+                                 verify_code, context, logger, timeout=timeout)
+        try:
+            conn.preconnect(pool_size)
+        except Exception:
+            conn.close()
+            raise
+    else:
+        # With a timeout, a stalled broker raises socket.timeout instead of
+        # hanging the caller forever. The RPC is not re-sent; the next call
+        # reconnects and signs on again, without the previous session state.
+        conn = VistARPCConnection(hostname, int(port), access_code, verify_code, context, logger,
+                                  timeout=timeout)
     return Connection(conn)
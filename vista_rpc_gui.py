@@ -2,11 +2,7 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import sys
 import os
-import json
-
-# Add the directory containing the vavista package to the Python path
-import sys
-import os
+from collections import namedtuple
 
 # Add the src directory to the Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
@@ -17,6 +13,37 @@ sys.path.append(os.path.join(os.path.dirname(__file__), 'vavista-rpc-master'))
 from vista_rpc_client import VistAClient
 from rpc_config_loader import RPCConfigLoader
 
+# Set VISTA_RPC_DEBUG=1 to echo debug traces (including raw replies and broker
+# connection/reply info) to stdout.
+DEBUG = bool(os.environ.get("VISTA_RPC_DEBUG"))
+
+# How often to ping the broker while connected so the session never idles out.
+KEEP_ALIVE_MS = 60 * 1000
+
+# Seconds to wait for the broker before an RPC fails with a timeout instead
+# of hanging the GUI; the connection then signs on again for the next call.
+RPC_TIMEOUT = 60
+
+def _debug(fmt, *args):
+    # Format lazily so large replies are not repr'd when debugging is off.
+    if DEBUG:
+        print("DEBUG: " + (fmt % args if args else fmt))
+
+# One row of a patient list (ORWPT LIST ALL, ORQPT PROVIDER PATIENTS).
+PatientRow = namedtuple("PatientRow", "DFN Name")
+
+def _parse_caret_rows(reply, count):
+    # First `count` (>= 2) caret fields of each reply line that has at least
+    # that many; the bounded split leaves any remaining fields unsplit.
+    rows = []
+    for line in reply.split('\r\n'):
+        if '^' not in line:  # Blank or malformed line, skip without splitting
+            continue
+        parts = line.split('^', count)
+        if len(parts) >= count:
+            rows.append(parts[:count])
+    return rows
+
 important_rpcs = [
     "ORQQAL LIST",
     "TIU SUMMARIES",
@@ -67,9 +94,10 @@ class RPCBrowser(tk.Toplevel):
     def _populate_tree(self):
         for category, rpcs_in_category in self.rpc_info.items():
             category_node = self.tree.insert("", "end", text=category, open=True)
-            for rpc_name, rpc_details in rpcs_in_category.items():
-                # Store rpc_details as a JSON string
-                self.tree.insert(category_node, "end", text=rpc_name, values=(rpc_name, json.dumps(rpc_details)))
+            for rpc_name in rpcs_in_category:
+                # Details are looked up from rpc_info on selection, so nothing
+                # is serialized while the tree is being built.
+                self.tree.insert(category_node, "end", text=rpc_name)
 
     def _on_rpc_selected(self, event):
         selected_item = self.tree.selection()
@@ -83,15 +111,14 @@ class RPCBrowser(tk.Toplevel):
             return
 
         rpc_name = self.tree.item(item_id, "text")
-        # Retrieve rpc_details as a JSON string and load it back into a dictionary
-        rpc_details_json = self.tree.item(item_id, "values")[1]
-        rpc_details = json.loads(rpc_details_json)
+        category = self.tree.item(parent_id, "text")
+        rpc_details = self.rpc_info[category][rpc_name]
 
         self.doc_text.config(state=tk.NORMAL)
         self.doc_text.delete(1.0, tk.END)
-        self.doc_text.insert(tk.END, f"**Description:**\n{rpc_details.get('description', 'N/A')}\n\n")
-        self.doc_text.insert(tk.END, f"**Parameters:**\n{rpc_details.get('parameters', 'N/A')}\n\n")
-        self.doc_text.insert(tk.END, f"**Returns:**\n{rpc_details.get('returns', 'N/A')}")
+        self.doc_text.insert(tk.END, f"**Description:**\n{rpc_details.description}\n\n")
+        self.doc_text.insert(tk.END, f"**Parameters:**\n{rpc_details.parameters}\n\n")
+        self.doc_text.insert(tk.END, f"**Returns:**\n{rpc_details.returns}")
         self.doc_text.config(state=tk.DISABLED)
 
         self.master.rpc_combobox.set(rpc_name)
@@ -100,7 +127,7 @@ class RPCBrowser(tk.Toplevel):
 class VistARPCGUI(tk.Tk):
 
     def _select_patient(self, dfn):
-        print(f"DEBUG: _select_patient called with dfn={dfn}")
+        _debug("_select_patient called with dfn=%s", dfn)
         if not self.vista_client.connection:
             messagebox.showwarning("RPC Error", "Not connected to VistA. Please connect first.")
             return
@@ -110,10 +137,7 @@ class VistARPCGUI(tk.Tk):
             reply = self.vista_client.select_patient(dfn)
             self._log_status(f"ORWPT SELECT Raw Reply: {reply!r}")
             # Parse the reply to get the patient's name
-            patient_name = "Unknown"
-            reply_parts = reply.split('^')
-            if len(reply_parts) > 0:
-                patient_name = reply_parts[0] # Assuming name is the first part
+            patient_name = reply.partition('^')[0] # Assuming name is the first part
             self._log_status(f"Successfully selected patient: {patient_name} (DFN: {dfn})")
             self.current_patient_label.config(text=f"{patient_name} (DFN: {dfn})") # Update patient label
             self.current_dfn = dfn # Store the current DFN
@@ -136,15 +160,9 @@ class VistARPCGUI(tk.Tk):
             # Let's try with just DFN for now, as the vista_rpc_client.py's fetch_patient_notes already handles it.
             notes_reply = self.vista_client.fetch_patient_notes(dfn)
             if notes_reply and notes_reply.strip():
-                notes_list = notes_reply.split('\r\n') # Use \r\n for consistency with other RPC replies
-                for note_info in notes_list:
-                    if note_info.strip():
-                        parts = note_info.split('^')
-                        if len(parts) >= 3:
-                            ien = parts[0]
-                            title = parts[1]
-                            date = parts[2]
-                            self.notes_tree.insert("", "end", values=(ien, title, date))
+                # Each row is IEN^Title^Date^...
+                for ien, title, date in _parse_caret_rows(notes_reply, 3):
+                    self.notes_tree.insert("", "end", values=(ien, title, date))
             else:
                 self.notes_tree.insert("", "end", values=("", "No notes found for this patient.", ""))
         except Exception as e:
@@ -176,16 +194,9 @@ class VistARPCGUI(tk.Tk):
             self._log_status(f"ORWPT LIST ALL Raw Reply: {patients_reply!r}")
 
             if patients_reply and patients_reply.strip():
-                patients_list = patients_reply.split('\r\n')
-                self.patients_data = []
-                for patient_info in patients_list:
-                    if patient_info.strip():
-                        parts = patient_info.split('^')
-                        if len(parts) >= 2:
-                            dfn = parts[0]
-                            name = parts[1]
-                            self.patients_data.append({"DFN": dfn, "Name": name})
-                
+                self.patients_data = list(map(PatientRow._make,
+                                              _parse_caret_rows(patients_reply, 2)))
+
                 if self.patients_data:
                     self._open_patient_selection()
                 else:
@@ -390,7 +401,7 @@ class VistARPCGUI(tk.Tk):
                 break
 
         if rpc_details:
-            parameters_doc = rpc_details.get('parameters', 'N/A')
+            parameters_doc = rpc_details.parameters
             if parameters_doc != 'N/A':
                 # Attempt to parse parameters and create a template
                 template_params = []
@@ -420,9 +431,8 @@ class VistARPCGUI(tk.Tk):
 
         # Special handling for TIU PERSONAL TITLE LIST (as it was before)
         if selected_rpc == "TIU PERSONAL TITLE LIST":
-            doctor_info = self.current_doctor_label.cget("text")
-            if "DUZ: " in doctor_info:
-                duz = doctor_info.split("DUZ: ")[1].split(")")[0]
+            duz = self.current_duz
+            if duz:
                 self.params_entry.delete(1.0, tk.END) # Clear previous template
                 self.params_entry.insert("1.0", f"literal:{duz};literal:3") # Default to ClassIEN 3 for Progress Notes
             else:
@@ -437,10 +447,10 @@ class VistARPCGUI(tk.Tk):
 
         self._log_status("Loading hospital locations...")
         try:
-            locations_reply = self.vista_client.invoke_rpc("ORWU HOSPLOC", "literal:;literal:1")
-            if locations_reply:
-                locations_list = locations_reply.split('\r\n')
-                self.locations = {loc.split('^')[1]: loc.split('^')[0] for loc in locations_list if loc.strip()}
+            locations = self.vista_client.get_hospital_locations()
+            if locations:
+                # The client returns an already-parsed name -> IEN map.
+                self.locations = locations
                 self.location_combobox['values'] = list(self.locations.keys())
                 self._log_status("Hospital locations loaded successfully.")
         except Exception as e:
@@ -454,10 +464,11 @@ class VistARPCGUI(tk.Tk):
 
         self._log_status("Loading providers...")
         try:
-            providers_reply = self.vista_client.invoke_rpc("ORWU NEWPERS", "literal:;literal:1")
-            if providers_reply:
-                providers_list = providers_reply.split('\r\n')
-                self.provider_combobox['values'] = [prov.split('^')[1] for prov in providers_list if prov.strip()]
+            providers = self.vista_client.get_providers()
+            if providers:
+                # Like locations, the client returns a parsed name -> IEN map.
+                self.providers.update(providers)
+                self.provider_combobox['values'] = list(self.providers.keys())
                 self._log_status("Providers loaded successfully.")
         except Exception as e:
             self._log_status(f"Failed to load providers: {e}")
@@ -468,9 +479,10 @@ class VistARPCGUI(tk.Tk):
         self.params_entry.delete(1.0, tk.END)
 
         if selected_rpc == "TIU PERSONAL TITLE LIST":
-            doctor_info = self.current_doctor_label.cget("text")
-            if "DUZ: " in doctor_info:
-                duz = doctor_info.split("DUZ: ")[1].split(")")[0]
+            # Use the DUZ stored by _update_doctor_info instead of parsing it
+            # back out of the label text.
+            duz = self.current_duz
+            if duz:
                 # Correctly format the parameters for this specific RPC
                 self.params_entry.insert("1.0", f"literal:{duz};literal:3")
             else:
@@ -493,7 +505,8 @@ class VistARPCGUI(tk.Tk):
 
         try:
             self._log_status("Attempting to connect to VistA...")
-            self.vista_client.connect_to_vista(host, port, access, verify, context)
+            self.vista_client.connect_to_vista(host, port, access, verify, context,
+                                               timeout=RPC_TIMEOUT, debug=DEBUG)
             self._log_status("Connection successful!")
             self.invoke_button.config(state=tk.NORMAL)
             self.get_patients_button.config(state=tk.NORMAL)
@@ -501,19 +514,29 @@ class VistARPCGUI(tk.Tk):
             self.connect_button.config(text="Connected", state=tk.DISABLED)
             # Update doctor info
             self._update_doctor_info()
+            self.after(KEEP_ALIVE_MS, self._keep_alive)
         except Exception as e:
             self._log_status(f"Connection failed: {e}")
             messagebox.showerror("Connection Error", f"Failed to connect: {e}")
             self.vista_client.connection = None
             self.connect_button.config(text="Connect", state=tk.NORMAL)
 
+    def _keep_alive(self):
+        if not self.vista_client.connection:
+            return
+        try:
+            self.vista_client.keep_alive()
+        except Exception as e:
+            self._log_status(f"Keep-alive failed: {e}")
+        self.after(KEEP_ALIVE_MS, self._keep_alive)
+
     def _update_doctor_info(self):
         try:
             user_info_reply = self.vista_client.get_user_info()
-            parts = user_info_reply.split('^')
-            if len(parts) >= 2:
-                duz = parts[0]
-                name = parts[1]
+            # DUZ^Name^...; only the first two fields are needed.
+            duz, sep, rest = user_info_reply.partition('^')
+            if sep:
+                name = rest.partition('^')[0]
                 self.current_doctor_label.config(text=f"{name} (DUZ: {duz})")
                 self.providers[name] = duz
                 self.provider_combobox['values'] = [name]
@@ -526,13 +549,13 @@ class VistARPCGUI(tk.Tk):
             self.current_doctor_label.config(text="N/A")
 
     def _invoke_rpc(self, event=None):
-        print(f"DEBUG: _invoke_rpc called with rpc_name={self.rpc_combobox.get()} and params_str={self.params_entry.get(1.0, tk.END).strip()}")
         if not self.vista_client.connection:
             messagebox.showwarning("RPC Error", "Not connected to VistA. Please connect first.")
             return
 
         rpc_name = self.rpc_combobox.get()
         params_str = self.params_entry.get(1.0, tk.END).strip()
+        _debug("_invoke_rpc called with rpc_name=%s and params_str=%s", rpc_name, params_str)
 
         try:
             reply = self.vista_client.invoke_rpc(rpc_name, params_str)
@@ -548,7 +571,7 @@ class VistARPCGUI(tk.Tk):
                 self.raw_response_text.insert(tk.END, reply)
             self.raw_response_text.config(state=tk.DISABLED)
             self._log_status(f"RPC '{rpc_name}' invoked successfully. Response length: {len(reply) if reply else 0}")
-            print(f"DEBUG: Raw RPC reply: {reply!r}")
+            _debug("Raw RPC reply: %r", reply)
         except Exception as e:
             self.raw_response_text.insert(tk.END, f"Error: {e}")
             self.raw_response_text.config(state=tk.DISABLED)
@@ -562,14 +585,17 @@ class VistARPCGUI(tk.Tk):
 
         self._log_status("Attempting to retrieve DOCTOR1's IEN...")
         try:
-            user_info_reply = self.vista_client.get_user_info()
-            self._log_status(f"ORWU USERINFO Raw Reply: {user_info_reply!r}")
-            
-            # Parse the user info reply to get the IEN
-            # The format is typically "DUZ^Name^...^IEN"
-            user_info_parts = user_info_reply.split('^')
-            if len(user_info_parts) > 0:
-                provider_ien = user_info_parts[0] # Assuming IEN is the first part
+            # _update_doctor_info already ran ORWU USERINFO on connect, so only
+            # repeat the RPC if that lookup failed.
+            provider_ien = self.current_duz
+            if not provider_ien:
+                user_info_reply = self.vista_client.get_user_info()
+                self._log_status(f"ORWU USERINFO Raw Reply: {user_info_reply!r}")
+
+                # Parse the user info reply to get the IEN
+                # The format is typically "DUZ^Name^...^IEN"
+                provider_ien = user_info_reply.partition('^')[0] # Assuming IEN is the first part
+            if provider_ien:
                 self._log_status(f"Retrieved Provider IEN: {provider_ien}")
 
                 self._log_status(f"Invoking ORQPT PROVIDER PATIENTS with IEN: {provider_ien}")
@@ -579,28 +605,22 @@ class VistARPCGUI(tk.Tk):
                 self.raw_response_text.config(state=tk.NORMAL)
                 self.raw_response_text.delete(1.0, tk.END)
                 
+                self.patients_data = []
                 if patients_reply:
                     patients_list = patients_reply.split('\r\n')
-                    formatted_output = "Patients for DOCTOR1 (IEN: " + provider_ien + "):\n"
+                    formatted_output = ["Patients for DOCTOR1 (IEN: " + provider_ien + "):\n"]
+                    # Build the display text and patients_data in the same pass.
                     for patient_info in patients_list:
                         if patient_info.strip():
                             # Assuming format is DFN^PatientName
-                            parts = patient_info.split('^')
-                            if len(parts) >= 2:
-                                dfn = parts[0]
-                                name = parts[1]
-                                formatted_output += f"DFN: {dfn}, Name: {name}\n"
+                            dfn, sep, rest = patient_info.partition('^')
+                            if sep:
+                                name = rest.partition('^')[0]
+                                formatted_output.append(f"DFN: {dfn}, Name: {name}\n")
+                                self.patients_data.append(PatientRow(dfn, name))
                             else:
-                                formatted_output += f"Raw: {patient_info}\n"
-                    self.raw_response_text.insert(tk.END, formatted_output)
-                self.patients_data = []
-                for patient_info in patients_list:
-                    if patient_info.strip():
-                        parts = patient_info.split('^')
-                        if len(parts) >= 2:
-                            dfn = parts[0]
-                            name = parts[1]
-                            self.patients_data.append({"DFN": dfn, "Name": name})
+                                formatted_output.append(f"Raw: {patient_info}\n")
+                    self.raw_response_text.insert(tk.END, "".join(formatted_output))
                 else:
                     self.raw_response_text.insert(tk.END, "No patients found for this provider or empty response.")
                 self.raw_response_text.config(state=tk.DISABLED)
@@ -642,7 +662,7 @@ class PatientSelectionWindow(tk.Toplevel):
         self.tree.pack(padx=10, pady=10, fill="both", expand=True)
 
         for patient in self.patients_data:
-            self.tree.insert("", "end", values=(patient["DFN"], patient["Name"]))
+            self.tree.insert("", "end", values=(patient.DFN, patient.Name))
 
         self.tree.bind("<Double-1>", self._on_double_click)
 